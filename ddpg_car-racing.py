@@ -15,8 +15,10 @@ import gym
 import tflearn
 import matplotlib.pyplot as plt
 
+from concurrent.futures import ThreadPoolExecutor
+from tensorflow.core.protobuf import rewriter_config_pb2
+
 from replay_buffer_ddpg import ReplayBuffer
-from skimage.color import rgb2grey
 
 # ==========================
 #   Training Parameters
@@ -34,13 +36,17 @@ MINI_LR = 1e-6
 GAMMA = 0.9
 # Soft target update param
 TAU = 0.01
+# Soft-update the target networks only every TARGET_UPDATE_STEP learning steps
+TARGET_UPDATE_STEP = 4
 EPS_DECAY_RATE = 0.99
 LR_DECAY_RATE = 0.99
 # ===========================
 #   Utility Parameters
 # ===========================
 # Render gym env during training
-RENDER_ENV = True
+RENDER_ENV = False
+# When rendering, only render one episode out of every RENDER_EVERY
+RENDER_EVERY = 50
 # Use Gym Monitor
 GYM_MONITOR_EN = False
 # Gym environment
@@ -55,11 +61,41 @@ BUFFER_SIZE = 10000
 MINIBATCH_SIZE = 64
 
 SAVE_STEP = 200
+# Copy the trained weights into the rollout policy every ROLLOUT_SYNC_STEP episodes
+ROLLOUT_SYNC_STEP = 1
+
+# Luma weights used by skimage's rgb2grey
+GREY_WEIGHTS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
 
 
 # ===========================
 #   Actor and Critic DNNs
 # ===========================
+def build_target_update(network_params, target_network_params, tau):
+    """
+    Soft update of the target weights towards the online weights,
+    grouped into a single op so it is scheduled as one unit
+    """
+    return tf.group(*[target_param.assign(tf.multiply(param, tau) + tf.multiply(target_param, 1. - tau))
+                      for param, target_param in zip(network_params, target_network_params)])
+
+
+def make_resource_template(name, network_fn):
+    """
+    tf.make_template whose variables are resource variables. Every use of a
+    resource variable is its own read op, so reads made under
+    tf.control_dependencies (e.g. after an optimizer step) see the updated value
+    """
+    def resource_network_fn(*args):
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True, auxiliary_name_scope=False):
+            return network_fn(*args)
+    return tf.make_template(name, resource_network_fn)
+
+
+# Actor output layers, in action order
+ACTOR_HEADS = ['actor_steering', 'actor_acceleration', 'actor_brake']
+
+
 class ActorNetwork(object):
     """ 
     Input to the network is the state, output is the action
@@ -75,70 +111,147 @@ class ActorNetwork(object):
         self.action_bound = action_bound
         self.tau = tau
 
+        # Online and target networks are templates built from the same
+        # function; each template owns its own variables
+        self.network = make_resource_template('actor', self.create_actor_network)
+        self.target_network = make_resource_template('actor_target', self.create_actor_network)
+
         # Actor Network
-        self.inputs, self.scaled_out = self.create_actor_network()
+        self.inputs = self.create_actor_inputs()
+        self.scaled_out = self.network(self.inputs)
 
-        self.learning_rate = tf.placeholder(tf.float32, [None,])
+        self.learning_rate = tf.placeholder(tf.float32, shape=[])
 
         self.network_params = tf.trainable_variables()
 
         # Target Network
-        self.target_inputs, self.target_scaled_out = self.create_actor_network()
+        self.target_inputs = self.create_actor_inputs()
+        self.target_scaled_out = self.target_network(self.target_inputs)
         
         self.target_network_params = tf.trainable_variables()[len(self.network_params):]
 
         # Op for periodically updating target network with online network weights
         self.update_target_network_params = \
-            [self.target_network_params[i].assign(tf.multiply(self.network_params[i], self.tau) + \
-                tf.multiply(self.target_network_params[i], 1. - self.tau))
-                for i in range(len(self.target_network_params))]
-
-        # This gradient will be provided by the critic network
-        self.action_gradient = tf.placeholder(tf.float32, [None, self.a_dim])
-        
-        # Combine the gradients here 
-        self.actor_gradients = tf.gradients(self.scaled_out, self.network_params, -self.action_gradient)
-
-        # Optimization Op
-        self.lr = tf.gather_nd(self.learning_rate,[0])
-        self.optimize = tf.train.AdamOptimizer(self.lr).\
-            apply_gradients(zip(self.actor_gradients, self.network_params))
+            build_target_update(self.network_params, self.target_network_params, self.tau)
 
         self.num_trainable_vars = len(self.network_params) + len(self.target_network_params)
 
-    def create_actor_network(self): 
-        inputs = tflearn.input_data(shape=[None, self.s_dim[0], self.s_dim[1], self.s_dim[2]])
-        net = tflearn.conv_2d(inputs, 8, 8, activation='relu', name='actor_conv1')
-        net = tflearn.conv_2d(inputs, 16, 8, activation='relu', name='actor_conv2')
+        # BN-folded copy of the online network used for rollout, see
+        # sync_rollout_weights().
+        # Only the weights and BN moving moments are read, not optimizer slots
+        scope = self.network.variable_scope.name + '/'
+        moving_moments = [v for v in tf.global_variables(scope)
+                          if v.op.name.endswith(('/moving_mean', '/moving_variance'))]
+        self.rollout_params = {v.op.name[len(scope):]: v for v in self.network_params + moving_moments}
+        self.rollout_sess = None
+        self.rollout_weights = None
+        self.rollout_inputs = None
+        self.rollout_out = None
+
+    def create_actor_inputs(self):
+        return tflearn.input_data(shape=[None, self.s_dim[0], self.s_dim[1], self.s_dim[2]], dtype=tf.uint8)
+
+    def create_actor_network(self, inputs):
+        # States are fed as uint8 pixels and scaled to [0, 1] on the device
+        net = tf.cast(inputs, tf.float32) / 255.
+        # Conv2D+BiasAdd+Relu is fused by Grappler's remapper
+        net = tflearn.conv_2d(net, 16, 8, activation='relu', name='actor_conv2')
         net = tflearn.layers.normalization.batch_normalization (net, name='actor_BatchNormalization1')
-        net = tflearn.fully_connected(inputs, 50, activation='relu')
+        net = tflearn.fully_connected(net, 50, activation='relu', name='actor_fc1')
         # net = tflearn.layers.normalization.batch_normalization (net, name='actor_BatchNormalization1')
         # net = tflearn.fully_connected(net, 50, activation='relu')
         net = tflearn.layers.normalization.batch_normalization (net, name='actor_BatchNormalization2')
         # Final layer weights are init to Uniform[-3e-3, 3e-3]
         w_init = tflearn.initializations.uniform(minval=-0.003, maxval=0.003)
-        steering = tflearn.fully_connected(net, 1, activation='tanh', weights_init=w_init)
-        acceleration = tflearn.fully_connected(net, 1, activation='sigmoid', weights_init=w_init)
-        brake = tflearn.fully_connected(net, 1, activation='sigmoid', weights_init=w_init)
+        steering = tflearn.fully_connected(net, 1, activation='tanh', weights_init=w_init, name=ACTOR_HEADS[0])
+        acceleration = tflearn.fully_connected(net, 1, activation='sigmoid', weights_init=w_init, name=ACTOR_HEADS[1])
+        brake = tflearn.fully_connected(net, 1, activation='sigmoid', weights_init=w_init, name=ACTOR_HEADS[2])
         scaled_out = tf.concat([steering,acceleration,brake],1)
 
-        return inputs, scaled_out 
-
-    def train(self, inputs, a_gradient, lr):
-        self.sess.run(self.optimize, feed_dict={
-            self.inputs: inputs,
-            self.action_gradient: a_gradient,
-            self.learning_rate: lr
-        })
-
-    def predict(self, inputs):
-        return self.sess.run(self.scaled_out, feed_dict={
-            self.inputs: inputs
-        })
-
-    def predict_target(self, inputs):
-        return self.sess.run(self.target_scaled_out, feed_dict={
-            self.target_inputs: inputs
+        return scaled_out
+
+    def fold_rollout_weights(self, params):
+        """
+        Fold both batch normalizations (inference moments) of the online
+        network into the dense layers that follow them. Returns the weights
+        create_rollout_network expects
+        """
+        def bn_scale_shift(name):
+            # tflearn's batch_normalization uses epsilon=1e-5
+            scale = params[name + '/gamma'] / np.sqrt(params[name + '/moving_variance'] + 1e-5)
+            return scale, params[name + '/beta'] - params[name + '/moving_mean'] * scale
+
+        # BN after the conv relu: fold into the hidden layer's inputs. The
+        # per-channel scale/shift repeats at every position of the flattened
+        # NHWC feature map
+        scale, shift = bn_scale_shift('actor_BatchNormalization1')
+        fc_W = params['actor_fc1/W']
+        positions = fc_W.shape[0] // scale.shape[0]
+        scale, shift = np.tile(scale, positions), np.tile(shift, positions)
+
+        # BN after the hidden layer: fold into the inputs of the output heads,
+        # stacked into one [50, 3] layer
+        head_scale, head_shift = bn_scale_shift('actor_BatchNormalization2')
+        head_W = np.concatenate([params[name + '/W'] for name in ACTOR_HEADS], 1)
+        head_b = np.concatenate([params[name + '/b'] for name in ACTOR_HEADS])
+
+        return {
+            'conv_W': params['actor_conv2/W'],
+            'conv_b': params['actor_conv2/b'],
+            'fc_W': scale[:, None] * fc_W,
+            'fc_b': shift.dot(fc_W) + params['actor_fc1/b'],
+            'head_W': head_scale[:, None] * head_W,
+            'head_b': head_shift.dot(head_W) + head_b,
+        }
+
+    def create_rollout_network(self, inputs, weights):
+        """
+        Inference-only version of create_actor_network on the folded weights
+        from fold_rollout_weights. sync_rollout_weights() checks it against scaled_out
+        """
+        net = tf.cast(inputs, tf.float32) / 255.
+        # tflearn's conv_2d defaults: stride 1, 'SAME' padding
+        net = tf.nn.conv2d(net, weights['conv_W'], [1, 1, 1, 1], 'SAME')
+        net = tf.nn.relu(tf.nn.bias_add(net, weights['conv_b']))
+        net = tf.reshape(net, [-1, int(weights['fc_W'].shape[0])])
+        net = tf.nn.relu(tf.matmul(net, weights['fc_W']) + weights['fc_b'])
+        net = tf.matmul(net, weights['head_W']) + weights['head_b']
+        # steering is tanh, acceleration and brake are sigmoid
+        return tf.concat([tf.tanh(net[:, :1]), tf.sigmoid(net[:, 1:])], 1)
+
+    def sync_rollout_weights(self, config=None):
+        """
+        Copy the online network's current weights, batch normalization folded
+        away, into the inference-only rollout session. The rollout graph and
+        session are built on the first call; later calls only reload the
+        weights. rollout() runs on this copy until the next sync
+        """
+        weights = self.fold_rollout_weights(self.sess.run(self.rollout_params))
+
+        first_sync = self.rollout_sess is None
+        if first_sync:
+            graph = tf.Graph()
+            with graph.as_default():
+                self.rollout_weights = {name: tf.Variable(tf.zeros(value.shape), trainable=False)
+                                        for name, value in weights.items()}
+                inputs = tf.placeholder(tf.uint8, [None, self.s_dim[0], self.s_dim[1], self.s_dim[2]])
+                scaled_out = self.create_rollout_network(inputs, self.rollout_weights)
+            self.rollout_sess = tf.Session(graph=graph, config=config)
+            self.rollout_inputs, self.rollout_out = inputs, scaled_out
+
+        for name, value in weights.items():
+            self.rollout_weights[name].load(value, self.rollout_sess)
+
+        if first_sync:
+            # Catch create_rollout_network drifting from create_actor_network
+            check = np.random.RandomState(RANDOM_SEED).randint(0, 256, [1] + list(self.s_dim)).astype(np.uint8)
+            if not np.allclose(self.rollout(check), self.sess.run(self.scaled_out, {self.inputs: check}),
+                               atol=1e-2):
+                print("Warning: rollout network output differs from the actor network")
+
+    def rollout(self, inputs):
+        return self.rollout_sess.run(self.rollout_out, feed_dict={
+            self.rollout_inputs: inputs
         })
 
     def update_target_network(self):
@@ -160,37 +273,38 @@ class CriticNetwork(object):
         self.a_dim = action_dim
         self.tau = tau
 
+        # Online and target networks are templates so they can be applied again
+        # to other tensors (e.g. the actor output) while sharing their weights
+        self.network = make_resource_template('critic', self.create_critic_network)
+        self.target_network = make_resource_template('critic_target', self.create_critic_network)
+
         # Create the critic network
-        self.inputs, self.action, self.out = self.create_critic_network()
+        self.inputs, self.action = self.create_critic_inputs()
+        self.out = self.network(self.inputs, self.action)
 
         self.network_params = tf.trainable_variables()[num_actor_vars:]
-        self.learning_rate = tf.placeholder(tf.float32, [None,])
+        self.learning_rate = tf.placeholder(tf.float32, shape=[])
 
         # Target Network
-        self.target_inputs, self.target_action, self.target_out = self.create_critic_network()
+        self.target_inputs, self.target_action = self.create_critic_inputs()
+        self.target_out = self.target_network(self.target_inputs, self.target_action)
         
         self.target_network_params = tf.trainable_variables()[(len(self.network_params) + num_actor_vars):]
 
         # Op for periodically updating target network with online network weights with regularization
         self.update_target_network_params = \
-            [self.target_network_params[i].assign(tf.multiply(self.network_params[i], self.tau) + tf.multiply(self.target_network_params[i], 1. - self.tau))
-                for i in range(len(self.target_network_params))]
-    
-        # Network target (y_i)
-        self.predicted_q_value = tf.placeholder(tf.float32, [None, 1])
-
-        # Define loss and optimization Op
-        self.loss = tflearn.mean_square(self.predicted_q_value, self.out)
-        self.lr = tf.gather_nd(self.learning_rate,[0])
-        self.optimize = tf.train.AdamOptimizer(self.lr).minimize(self.loss)
+            build_target_update(self.network_params, self.target_network_params, self.tau)
 
-        # Get the gradient of the net w.r.t. the action
-        self.action_grads = tf.gradients(self.out, self.action)
-
-    def create_critic_network(self):
-        inputs = tflearn.input_data(shape=[None, self.s_dim[0], self.s_dim[1], self.s_dim[2]])
+    def create_critic_inputs(self):
+        inputs = tflearn.input_data(shape=[None, self.s_dim[0], self.s_dim[1], self.s_dim[2]], dtype=tf.uint8)
         action = tflearn.input_data(shape=[None, self.a_dim])
-        net = tflearn.conv_2d(inputs, 8, 8, activation='relu', name='critic_conv1')
+        return inputs, action
+
+    def create_critic_network(self, inputs, action):
+        # States are fed as uint8 pixels and scaled to [0, 1] on the device
+        net = tf.cast(inputs, tf.float32) / 255.
+        # Conv2D+BiasAdd+Relu is fused by Grappler's remapper
+        net = tflearn.conv_2d(net, 8, 8, activation='relu', name='critic_conv1')
         # net = tflearn.conv_2d(net, 8, 8, activation='relu', name='critic_conv2')
         net = tflearn.layers.normalization.batch_normalization (net, name='critic_BatchNormalization1')
         net = tflearn.fully_connected(net, 100, activation='relu')
@@ -206,36 +320,69 @@ class CriticNetwork(object):
         # Weights are init to Uniform[-3e-3, 3e-3]
         w_init = tflearn.initializations.uniform(minval=-0.003, maxval=0.003)
         out = tflearn.fully_connected(net, 1, weights_init=w_init)
-        return inputs, action, out
-
-    def train(self, inputs, action, predicted_q_value, lr):
-        return self.sess.run([self.out, self.optimize], feed_dict={
-            self.inputs: inputs,
-            self.action: action,
-            self.predicted_q_value: predicted_q_value,
-            self.learning_rate: lr
-        })
+        return out
 
-    def predict(self, inputs, action):
-        return self.sess.run(self.out, feed_dict={
-            self.inputs: inputs,
-            self.action: action
-        })
+    def update_target_network(self):
+        self.sess.run(self.update_target_network_params)
 
-    def predict_target(self, inputs, action):
-        return self.sess.run(self.target_out, feed_dict={
-            self.target_inputs: inputs,
-            self.target_action: action
-        })
 
-    def action_gradients(self, inputs, actions): 
-        return self.sess.run(self.action_grads, feed_dict={
-            self.inputs: inputs,
-            self.action: actions
-        })
+# ===========================
+#   Combined Training Op
+# ===========================
+def build_train_step(actor, critic):
+    """
+    One DDPG learning step as a single op: critic regression on the
+    Bellman target computed from the target networks, actor update through
+    the freshly updated critic, then the soft target updates.
+
+    Two variants are returned: train_step includes the soft target update,
+    learn_step stops after the actor update. The target update uses the tau
+    equivalent to TARGET_UPDATE_STEP consecutive updates with the networks' tau,
+    so running train_step once every TARGET_UPDATE_STEP learning steps keeps
+    the same smoothing.
+
+    The minibatch is fed through actor.inputs (s), critic.action (a),
+    actor.target_inputs (s2) and the returned rewards / terminals placeholders.
+    """
+    rewards = tf.placeholder(tf.float32, [None])
+    terminals = tf.placeholder(tf.float32, [None])
 
-    def update_target_network(self):
-        self.sess.run(self.update_target_network_params)
+    target_q = critic.target_network(actor.target_inputs, actor.target_scaled_out)
+    predicted_q_value = critic.network(actor.inputs, critic.action)
+
+    # Calculate targets
+    y_i = tf.expand_dims(rewards, 1) + GAMMA * tf.expand_dims(1. - terminals, 1) * target_q
+    loss = tflearn.mean_square(y_i, predicted_q_value)
+
+    # Both optimizers use dynamic loss scaling so fp16 gradients from the
+    # mixed precision rewrite do not underflow
+    critic_optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
+        tf.train.AdamOptimizer(critic.learning_rate), loss_scale='dynamic')
+    actor_optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(
+        tf.train.AdamOptimizer(actor.learning_rate), loss_scale='dynamic')
+
+    # Update the critic given the targets
+    critic_optimize = critic_optimizer.minimize(loss, var_list=critic.network_params)
+
+    # Update the actor policy using the sampled gradient of the updated critic.
+    # The critic weights are resource variables read inside this block, so the
+    # surrogate -sum(Q(s, mu(s))) is evaluated with the post-update critic; its
+    # gradient over the actor weights is that critic's -dQ/da chained through mu
+    with tf.control_dependencies([critic_optimize]):
+        actor_loss = -tf.reduce_sum(critic.network(actor.inputs, actor.scaled_out))
+        actor_optimize = actor_optimizer.minimize(actor_loss, var_list=actor.network_params)
+
+    learn_step = tf.group(actor_optimize)
+
+    # Update target networks
+    with tf.control_dependencies([actor_optimize]):
+        train_step = tf.group(
+            build_target_update(actor.network_params, actor.target_network_params,
+                                1. - (1. - actor.tau) ** TARGET_UPDATE_STEP),
+            build_target_update(critic.network_params, critic.target_network_params,
+                                1. - (1. - critic.tau) ** TARGET_UPDATE_STEP))
+
+    return train_step, learn_step, predicted_q_value, rewards, terminals
 
 
 # ===========================
@@ -258,6 +405,9 @@ def build_summaries():
 # ===========================
 def train(sess, env, actor, critic, global_step):
 
+    # Set up the combined training Op
+    train_step, learn_step, predicted_q, rewards, terminals = build_train_step(actor, critic)
+
     # Set up summary Ops
     summary_ops, summary_vars = build_summaries()
 
@@ -281,88 +431,89 @@ def train(sess, env, actor, critic, global_step):
     actor.update_target_network()
     critic.update_target_network()
 
+    # Inference-only session for the rollout policy
+    rollout_config = build_session_config()
+    rollout_config.graph_options.rewrite_options.pin_to_host_optimization = \
+        rewriter_config_pb2.RewriterConfig.ON
+
     # Initialize replay memory
-    replay_buffer = ReplayBuffer(BUFFER_SIZE, RANDOM_SEED)
+    # The training step is fed the current lr, so transitions do not keep it
+    replay_buffer = ReplayBuffer(BUFFER_SIZE, RANDOM_SEED, store_lr=False)
+
+    # Every env call goes through this one thread: CarRacing renders from
+    # reset/step/render, and its pyglet GL context must stay on a single thread.
+    # env.step then runs in the background while the networks train
+    env_worker = ThreadPoolExecutor(max_workers=1)
 
     i = global_step.eval()
+    # Learning steps run so far, gates the target network updates
+    learn_steps = 0
     eps = 0.99
     lr = INITIAL_LR
 
     while True:
         i += 1
-        s = env.reset()
-        # s = prepro(s)
+        s = prepro(env_worker.submit(env.reset).result())
         ep_reward = 0
         ep_ave_max_q = 0
         eps *= EPS_DECAY_RATE
         lr *= LR_DECAY_RATE
         lr = np.max([lr, MINI_LR]) # minimum of learning rate is MINI_LR
+        render = RENDER_ENV and i % RENDER_EVERY == 0
         if i % SAVE_STEP == 0 : # save check point every 1000 episode
             sess.run(global_step.assign(i))
             save_path = saver.save(sess, "./results/model.ckpt" , global_step = global_step)
             print("Model saved in file: %s" % save_path)
             print("Successfully saved global step: ", global_step.eval())
+        if actor.rollout_sess is None or i % ROLLOUT_SYNC_STEP == 0:
+            actor.sync_rollout_weights(rollout_config)
+
+        # Draw the episode's exploration randomness up front, one row per step
+        explore = np.random.rand(MAX_EP_STEPS) <= eps
+        random_actions = np.random.uniform(-1, 1, (MAX_EP_STEPS, 3))
+        random_actions[:, 1] += np.random.uniform(0, 1, MAX_EP_STEPS)
+        noise = np.random.normal(0, 0.2*eps, (MAX_EP_STEPS, 3))
+        noise[:, 1] = np.random.normal(0.4, 0.1*eps, MAX_EP_STEPS)
 
         for j in range(MAX_EP_STEPS):
 
-            if RENDER_ENV: 
-                env.render()
+            if render:
+                env_worker.submit(env.render).result()
             # print(s.shape)
 
-            if np.random.rand() <= eps:
-                action = np.random.uniform(-1, 1, 3)
-                action[1] = action[1] + np.random.uniform(0, 1)
-                action = np.expand_dims(action, axis=0)
+            if explore[j]:
+                action = random_actions[j:j+1]
             else:
-                action = actor.predict(np.reshape(s,(-1,96,96,3)))
+                action = actor.rollout(np.reshape(s,(-1,96,96,1)))
             # np.random.uniform(0, 1, 3)
             # action = a[0] + 1./(1+i+j) # add noise for exploration
-            noise = np.random.normal(0,0.2*eps, 3)
-            noise[1] = np.random.normal(0.4,0.1*eps)
-            action[0] = action[0] + noise
-            s2, r, terminal, info = env.step(action[0])
-            # s2 = prepro(s2)
-            # plt.imshow(s2)
-            # plt.show()
-            # if r > 0:
-            #     r = 1
-            # elif r < 0:
-            #     r = -1
-            # print 'r: ',r
-            # replay_buffer.add(np.reshape(s, (96, 96, 3)), np.reshape(action, (actor.a_dim,)), r,
-            #     terminal, np.reshape(s2, (96, 96, 3)),lr)
-            replay_buffer.add(s, np.reshape(action, (actor.a_dim,)), r,
-                terminal, s2,lr)
+            action[0] = action[0] + noise[j]
+            env_step = env_worker.submit(env.step, action[0])
+
+            # Train on the replay memory while the env steps; the transition
+            # being collected is added once the step returns.
             # Keep adding experience to the memory until
             # there are at least minibatch size samples
             if replay_buffer.size() > MINIBATCH_SIZE:     
-                s_batch, a_batch, r_batch, t_batch, s2_batch, lr_batch = \
+                s_batch, a_batch, r_batch, t_batch, s2_batch, _ = \
                     replay_buffer.sample_batch(MINIBATCH_SIZE)
 
-                # Calculate targets
-                target_q = critic.predict_target(s2_batch, actor.predict_target(s2_batch))
-
-                y_i = []
-                for k in range(MINIBATCH_SIZE):
-                    if t_batch[k]:
-                        y_i.append(r_batch[k])
-                    else:
-                        y_i.append(r_batch[k] + GAMMA * target_q[k])
-
-                # Update the critic given the targets
-                predicted_q_value, _ = critic.train(s_batch, a_batch, np.reshape(y_i, (MINIBATCH_SIZE, 1)), lr_batch)
+                # Update critic and actor in one run, and the target
+                # networks with it every TARGET_UPDATE_STEP learning steps
+                learn_steps += 1
+                step = train_step if learn_steps % TARGET_UPDATE_STEP == 0 else learn_step
+                _, predicted_q_value = sess.run([step, predicted_q], feed_dict={
+                    actor.inputs: s_batch,
+                    critic.action: a_batch,
+                    rewards: r_batch,
+                    terminals: t_batch,
+                    actor.target_inputs: s2_batch,
+                    actor.learning_rate: lr,
+                    critic.learning_rate: lr
+                })
 
                 ep_ave_max_q += np.amax(predicted_q_value)
                 # print ep_ave_max_q
-                # Update the actor policy using the sampled gradient
-                a_outs = actor.predict(s_batch)
-                grads = critic.action_gradients(s_batch, a_outs)
-                # print grads[0]
-                actor.train(s_batch, grads[0], lr_batch)
-
-                # Update target networks
-                actor.update_target_network()
-                critic.update_target_network()
                 summary_str = sess.run(summary_ops, feed_dict={
                     summary_vars[0]: ep_reward,
                     summary_vars[1]: ep_ave_max_q / float(j)
@@ -373,6 +524,20 @@ def train(sess, env, actor, critic, global_step):
 
                 print('| Reward: %.2i' % int(ep_reward), " | Episode", i, '| Qmax: %.4f' % (ep_ave_max_q / float(j)))
 
+            s2, r, terminal, info = env_step.result()
+            s2 = prepro(s2)
+            # plt.imshow(s2)
+            # plt.show()
+            # if r > 0:
+            #     r = 1
+            # elif r < 0:
+            #     r = -1
+            # print 'r: ',r
+            # replay_buffer.add(np.reshape(s, (96, 96, 3)), np.reshape(action, (actor.a_dim,)), r,
+            #     terminal, np.reshape(s2, (96, 96, 3)),lr)
+            replay_buffer.add(s, np.reshape(action, (actor.a_dim,)), r,
+                terminal, s2,lr)
+
             s = s2
             ep_reward += r
 
@@ -392,11 +557,37 @@ def train(sess, env, actor, critic, global_step):
                 break
 
 
-def main(_):
+def prepro(state):
+    """ prepro 96x96x3 uint8 frame into a 96x96x1 uint8 grey image """
+    return (np.einsum('hwc,c->hw', state, GREY_WEIGHTS) + 0.5).astype(np.uint8)[..., None]
+
+
+def build_session_config():
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
+    # Grappler passes: fuse Conv+BN+Relu blocks and fold constants
+    rewrite_options = config.graph_options.rewrite_options
+    rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+    # tflearn builds NHWC convs; on GPU the layout optimizer runs them as
+    # NCHW (cuDNN's faster layout) and keeps the transposes at the graph edges.
+    # The convs are not built as NCHW directly: tflearn's conv_2d has no
+    # data_format option and NCHW Conv2D has no CPU kernel
+    rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.arithmetic_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.dependency_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.function_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.implementation_selector = rewriter_config_pb2.RewriterConfig.ON
+    # Run conv/matmul in fp16 on the GPU, placeholders and variables stay fp32;
+    # build_train_step adds the matching dynamic loss scaling
+    rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    return config
+
+
+def main(_):
+    config = build_session_config()
 
-    with tf.Session() as sess:
+    with tf.Session(config=config) as sess:
         
         global_step = tf.Variable(0, name='global_step', trainable=False)
         env = gym.make(ENV_NAME)
@@ -404,7 +595,7 @@ def main(_):
         tf.set_random_seed(RANDOM_SEED)
         env.seed(RANDOM_SEED)
 
-        state_dim = [96, 96, 3]
+        state_dim = [96, 96, 1]
         action_dim = env.action_space.shape[0]
         action_bound = env.action_space.high
         print('state_dim: ',state_dim)
@@ -1,53 +1,84 @@
-""" 
+"""
 Data structure for implementing experience replay
 
 Author: Patrick Emami
 """
-from collections import deque
-import random
 import numpy as np
 
 class ReplayBuffer(object):
 
-    def __init__(self, buffer_size, random_seed=123):
+    def __init__(self, buffer_size, random_seed=123, store_lr=True):
         """
-        The right side of the deque contains the most recent experiences 
+        Transitions are kept in one preallocated array per field, used as a
+        ring buffer: ptr is the next slot to write, the oldest entry is
+        overwritten once the buffer is full.
+        With store_lr=False the learning rate passed to add() is dropped and
+        sample_batch returns None in its place
         """
         self.buffer_size = buffer_size
+        self.store_lr = store_lr
         self.count = 0
-        self.buffer = deque()
-        random.seed(random_seed)
+        self.ptr = 0
+        self.rng = np.random.RandomState(random_seed)
+        # Allocated on the first add, once the shapes are known
+        self.states = None
+        # Minibatch output arrays, allocated on the first sample_batch
+        self.batch = None
+
+    def _allocate(self, s, a):
+        s = np.asarray(s)
+        a = np.asarray(a)
+        self.states = np.empty((self.buffer_size,) + s.shape, dtype=s.dtype)
+        self.actions = np.empty((self.buffer_size,) + a.shape, dtype=np.float32)
+        self.rewards = np.empty(self.buffer_size, dtype=np.float32)
+        self.terminals = np.empty(self.buffer_size, dtype=np.bool_)
+        self.next_states = np.empty((self.buffer_size,) + s.shape, dtype=s.dtype)
+        self.lrs = np.empty(self.buffer_size, dtype=np.float32) if self.store_lr else None
 
     def add(self, s, a, r, t, s2, lr):
-        experience = (s, a, r, t, s2, lr)
-        if self.count < self.buffer_size: 
-            self.buffer.append(experience)
-            self.count += 1
-        else:
-            self.buffer.popleft()
-            self.buffer.append(experience)
+        if self.states is None:
+            self._allocate(s, a)
+
+        self.states[self.ptr] = s
+        self.actions[self.ptr] = a
+        self.rewards[self.ptr] = r
+        self.terminals[self.ptr] = t
+        self.next_states[self.ptr] = s2
+        if self.store_lr:
+            self.lrs[self.ptr] = lr
+
+        self.ptr = (self.ptr + 1) % self.buffer_size
+        self.count = min(self.count + 1, self.buffer_size)
 
     def size(self):
         return self.count
 
     def sample_batch(self, batch_size):
-        batch = []
+        """
+        The minibatch is gathered into arrays that are reused across calls,
+        so the returned batch is only valid until the next sample_batch
+        """
+        if self.states is None:
+            # Nothing added yet, so the field shapes are unknown
+            return tuple(np.array([]) for _ in range(6))
 
-        if self.count < batch_size:
-            batch = random.sample(self.buffer, self.count)
-        else:
-            batch = random.sample(self.buffer, batch_size)
+        batch_size = min(batch_size, self.count)
+        idx = self.rng.randint(0, self.count, size=batch_size)
 
-        s_batch = np.array([_[0] for _ in batch])
-        a_batch = np.array([_[1] for _ in batch])
-        r_batch = np.array([_[2] for _ in batch])
-        t_batch = np.array([_[3] for _ in batch])
-        s2_batch = np.array([_[4] for _ in batch])
-        lr_batch = np.array([_[5] for _ in batch])
-        return s_batch, a_batch, r_batch, t_batch, s2_batch, lr_batch
+        if self.batch is None or len(self.batch[0]) != batch_size:
+            self.batch = tuple(np.empty((batch_size,) + field.shape[1:], dtype=field.dtype)
+                               for field in self.fields())
 
-    def clear(self):
-        self.deque.clear()
-        self.count = 0
+        # idx is always in range; mode='clip' lets np.take write straight
+        # into out, the default 'raise' gathers into a temporary first
+        for field, out in zip(self.fields(), self.batch):
+            np.take(field, idx, axis=0, out=out, mode='clip')
+        return self.batch if self.store_lr else self.batch + (None,)
 
+    def fields(self):
+        fields = (self.states, self.actions, self.rewards, self.terminals, self.next_states)
+        return fields + (self.lrs,) if self.store_lr else fields
 
+    def clear(self):
+        self.count = 0
+        self.ptr = 0